@@ -1,110 +1,341 @@
 # api_clients.py
 import os
+import re
+import time
+import functools
 import httpx
+import orjson
+from pydantic import BaseModel
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, stop_before_delay, wait_random_exponential
 
 # Configure atomic service base URLs via environment variables for flexibility.
 USERS_BASE = os.getenv("USERS_BASE", "http://localhost:8000/api/v1/users")
 ADDRESSES_BASE = os.getenv("ADDRESSES_BASE", "http://localhost:8001/addresses")
+# Tolerate Python-repr bodies from the users service; turn off once upstream emits valid JSON.
+USERS_PYREPR_FALLBACK = os.getenv("USERS_PYREPR_FALLBACK", "true").lower() in ("1", "true", "yes")
 
+# Connection pool sizing shared by the upstream clients.
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
 
-def _url(base: str, *parts: object) -> str:
-	"""Join base and parts into a single URL, avoiding duplicate slashes.
+
+def _make_client(base: str, transport=None) -> httpx.AsyncClient:
+	"""Build a pooled keep-alive client rooted at an atomic service base URL.
+	"""
+	# Follow redirects so upstream trailing-slash differences (307) resolve in one call.
+	return httpx.AsyncClient(
+		base_url=base.rstrip('/') + '/',
+		timeout=10,
+		limits=_LIMITS,
+		http2=True,
+		follow_redirects=True,
+		transport=transport,
+	)
+
+
+# Long-lived clients so connections are reused across requests instead of
+# paying a fresh TCP/TLS handshake per upstream call. Created by open_clients()
+# on application startup and released by close_clients() on shutdown.
+_ADDR_CLIENT = None
+_USERS_CLIENT = None
+
+# Short-lived cache of user lookups keyed by user_id. Composite endpoints hit
+# get_user on most requests to check the logical FK, so hits skip a network hop.
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=30)
+
+
+class CircuitBreakerError(Exception):
+	"""Raised when a call is rejected because the upstream's circuit is open."""
+
+
+def _is_outage(exc: Exception) -> bool:
+	"""Transport failures and 5xx responses count against a breaker; 4xx do not."""
+	if isinstance(exc, httpx.TransportError):
+		return True
+	return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code >= 500
+
+
+class CircuitBreaker:
+	"""Per-upstream CLOSED -> OPEN -> HALF_OPEN circuit breaker for async calls.
+
+	After `fail_max` consecutive outage failures the circuit opens and calls fail
+	fast with CircuitBreakerError. Once `reset_timeout` seconds have passed a
+	single trial call is let through; success closes the circuit, failure
+	re-opens it.
+	"""
+
+	def __init__(self, name: str, fail_max: int = 5, reset_timeout: float = 30):
+		self.name = name
+		self.fail_max = fail_max
+		self.reset_timeout = reset_timeout
+		self._failures = 0
+		self._opened_at = None
+
+	def __call__(self, func):
+		@functools.wraps(func)
+		async def wrapper(*args, **kwargs):
+			if self._opened_at is not None:
+				if time.monotonic() - self._opened_at < self.reset_timeout:
+					raise CircuitBreakerError(f"{self.name} service unavailable (circuit open)")
+				# Half-open: re-arm the timer so only this trial call goes through
+				self._opened_at = time.monotonic()
+			try:
+				result = await func(*args, **kwargs)
+			except Exception as e:
+				if _is_outage(e):
+					self._failures += 1
+					if self._failures >= self.fail_max:
+						self._opened_at = time.monotonic()
+				else:
+					self.reset()
+				raise
+			self.reset()
+			return result
+		return wrapper
+
+	@property
+	def state(self) -> str:
+		"""Current state: "closed", "open" or "half_open" (trial call allowed)."""
+		if self._opened_at is None:
+			return "closed"
+		if time.monotonic() - self._opened_at < self.reset_timeout:
+			return "open"
+		return "half_open"
+
+	def reset(self) -> None:
+		"""Close the circuit and clear the failure count."""
+		self._failures = 0
+		self._opened_at = None
+
+
+_ADDR_BREAKER = CircuitBreaker("addresses")
+_USER_BREAKER = CircuitBreaker("users")
+
+def _is_retryable(exc: Exception) -> bool:
+	"""Outages worth retrying: not timeouts, which already spent the 10s budget."""
+	return _is_outage(exc) and not isinstance(exc, httpx.TimeoutException)
+
+
+# Short jittered retry for idempotent calls only (never creates). Applied
+# inside the breakers, so a logical call counts as one failure however many
+# attempts it made, and an open circuit rejects the call before any attempt.
+# Only fast failures (connection resets, quick 5xx) are retried, and no new
+# attempt starts once 2s have been spent, so a hung upstream still gives up
+# at the client timeout instead of multiplying it.
+# RETRY_BACKOFF is looked up per attempt so it can be swapped (e.g. in tests).
+RETRY_BACKOFF = wait_random_exponential(multiplier=0.1, max=2)
+_retry = retry(
+	retry=retry_if_exception(_is_retryable),
+	wait=lambda retry_state: RETRY_BACKOFF(retry_state),
+	stop=stop_after_attempt(3) | stop_before_delay(2),
+	reraise=True,
+)
+
+
+def _json_body(payload, exclude=None) -> dict:
+	"""Request kwargs for a JSON body.
+
+	Pydantic models are serialized straight to JSON by pydantic-core, skipping
+	the intermediate dict; plain dicts go through httpx's `json=`.
+	"""
+	if isinstance(payload, BaseModel):
+		return {
+			"content": payload.model_dump_json(exclude=exclude),
+			"headers": {"content-type": "application/json"},
+		}
+	return {"json": payload}
+
+
+def reset_state() -> None:
+	"""Clear the user cache and close both circuits (for tests and recovery)."""
+	global _IDS_QUERY_UNSUPPORTED
+	_USER_CACHE.clear()
+	_ADDR_BREAKER.reset()
+	_USER_BREAKER.reset()
+	_IDS_QUERY_UNSUPPORTED = False
+
+
+def open_clients(transport=None) -> None:
+	"""Create the pooled upstream clients (called on application startup).
+
+	`transport` replaces the network transport, e.g. httpx.MockTransport in tests.
 	"""
-	url = base.rstrip('/')
-	for p in parts:
-		url += '/' + str(p).lstrip('/')
-	return url
+	global _ADDR_CLIENT, _USERS_CLIENT
+	_ADDR_CLIENT = _make_client(ADDRESSES_BASE, transport)
+	_USERS_CLIENT = _make_client(USERS_BASE, transport)
+
 
+async def close_clients() -> None:
+	"""Close the pooled upstream clients (called on application shutdown)."""
+	global _ADDR_CLIENT, _USERS_CLIENT
+	clients, _ADDR_CLIENT, _USERS_CLIENT = (_ADDR_CLIENT, _USERS_CLIENT), None, None
+	for client in clients:
+		if client is not None:
+			await client.aclose()
 
-def get_addresses(params=None):
+
+@_ADDR_BREAKER
+@_retry
+async def get_addresses(params=None):
 	"""Fetch addresses from the atomic addresses microservice.
+	"""
+	r = await _ADDR_CLIENT.get("", params=params)
+	r.raise_for_status()
+	return orjson.loads(r.content)
+
+
+@_ADDR_BREAKER
+@_retry
+async def stream_addresses(params=None) -> httpx.Response:
+	"""Open a streaming address list request for byte-for-byte pass-through.
+
+	The body is left unread; the caller must close the response (aclose()).
+	"""
+	r = await _ADDR_CLIENT.send(_ADDR_CLIENT.build_request("GET", "", params=params), stream=True)
+	try:
+		r.raise_for_status()
+	except httpx.HTTPStatusError:
+		await r.aclose()
+		raise
+	return r
 
-	Try both trailing and non-trailing base URL forms to avoid 307 redirect errors
-	when upstream differs on slash handling.
+
+@_ADDR_BREAKER
+@_retry
+async def get_address(address_id: str):
+	r = await _ADDR_CLIENT.get(f"/{address_id}")
+	r.raise_for_status()
+	return orjson.loads(r.content)
+
+
+# Set once the atomic service turns out not to support batch lookup by id.
+_IDS_QUERY_UNSUPPORTED = False
+
+
+@_ADDR_BREAKER
+async def get_addresses_by_ids(ids: list):
+	"""Fetch several addresses in one call via the atomic service's id query.
+
+	Returns None when the batch result can't be trusted to be exactly the
+	requested addresses (no id-filter endpoint, filter ignored, or records
+	missing); callers should then fall back to per-id get_address calls.
 	"""
-	exc = None
-	for candidate in (_url(ADDRESSES_BASE), _url(ADDRESSES_BASE, "")):
-		try:
-			r = httpx.get(candidate, params=params, timeout=10)
-			r.raise_for_status()
-			return r.json()
-		except httpx.HTTPStatusError as e:
-			exc = e
-			# try next candidate
-			continue
-	if exc:
-		raise exc
-	raise RuntimeError("Address list fetch failed for unknown reasons")
-
-
-def get_address(address_id: str):
-	r = httpx.get(_url(ADDRESSES_BASE, address_id), timeout=10)
+	global _IDS_QUERY_UNSUPPORTED
+	if _IDS_QUERY_UNSUPPORTED:
+		return None
+	# Ask for a page large enough to hold every requested id
+	r = await _ADDR_CLIENT.post("query", json={"ids": ids, "limit": len(ids)})
+	if 400 <= r.status_code < 500:
+		# Any client error means the endpoint won't serve this query; stop paying
+		# a wasted POST before the fan-out on every later request.
+		_IDS_QUERY_UNSUPPORTED = True
+		return None
 	r.raise_for_status()
-	return r.json()
+	body = orjson.loads(r.content)
+	# Accept either a bare list or the paginated {"data": [...]} shape
+	records = body.get("data", []) if isinstance(body, dict) else body
+	wanted = {str(i) for i in ids}
+	by_id = {}
+	for record in records:
+		rid = str(record.get("id")) if isinstance(record, dict) else None
+		if rid not in wanted:
+			# Upstream ignored the id filter (e.g. pydantic drops unknown fields)
+			_IDS_QUERY_UNSUPPORTED = True
+			return None
+		by_id[rid] = record
+	if len(by_id) != len(wanted):
+		return None
+	return list(by_id.values())
 
 
-def create_address_atomic(address_payload: dict):
+@_ADDR_BREAKER
+async def create_address_atomic(address_payload, exclude=None):
 	"""Create an address in the atomic addresses microservice.
+
+	`address_payload` may be a dict or a pydantic model; `exclude` names model
+	fields to leave out of the request body.
 	"""
-	# Some atomic services differ on trailing-slash handling; try both forms.
-	exc = None
-	for candidate in (_url(ADDRESSES_BASE), _url(ADDRESSES_BASE, "")):
-		try:
-			r = httpx.post(candidate, json=address_payload, timeout=10)
-			r.raise_for_status()
-			return r.json()
-		except httpx.HTTPStatusError as e:
-			exc = e
-			# if redirect, attempt next candidate
-			continue
-	# If we get here, all attempts failed
-	if exc:
-		raise exc
-	raise RuntimeError("Address creation failed for unknown reasons")
-
-
-def delete_address(address_id: str):
+	r = await _ADDR_CLIENT.post("", **_json_body(address_payload, exclude))
+	r.raise_for_status()
+	return orjson.loads(r.content)
+
+
+@_ADDR_BREAKER
+@_retry
+async def delete_address(address_id: str):
 	"""Delegate delete call to atomic addresses microservice"""
-	r = httpx.delete(_url(ADDRESSES_BASE, address_id), timeout=10)
+	r = await _ADDR_CLIENT.delete(f"/{address_id}")
 	r.raise_for_status()
 	# Some atomic services return 204 No Content; normalize to dict
 	if r.status_code == 204 or not r.text:
 		return {"status": "deleted", "id": address_id}
-	return r.json()
+	return orjson.loads(r.content)
 
 
-def get_user(user_id: int):
-	r = httpx.get(_url(USERS_BASE, user_id), timeout=10)
-	r.raise_for_status()
+# Python literals to their JSON equivalents, rewritten in one pass. Quoted
+# strings are matched first and kept as-is, so values like "True" survive.
+_PYREPR_RE = re.compile(rb'"(?:\\.|[^"\\])*"|\b(None|True|False)\b')
+_PYREPR_MAP = {b"None": b"null", b"True": b"true", b"False": b"false"}
+
+
+def _pyrepr_sub(m: re.Match) -> bytes:
+	literal = m.group(1)
+	return m.group(0) if literal is None else _PYREPR_MAP[literal]
+
+
+def _loads_user(r: httpx.Response):
+	"""Parse a users service response body.
+	"""
+	if not USERS_PYREPR_FALLBACK:
+		return orjson.loads(r.content)
 	try:
-		return r.json()
-	except Exception:
+		return orjson.loads(r.content)
+	except orjson.JSONDecodeError:
 		# Upstream may return Python-style reprs (e.g. None) instead of valid JSON.
 		# Try a tolerant fallback by replacing Python `None`/`True`/`False` with
 		# JSON `null`/`true`/`false` and parsing.
-		import json
-		text = r.text
-		cleaned = text.replace("None", "null").replace("True", "true").replace("False", "false")
-		return json.loads(cleaned)
+		return orjson.loads(_PYREPR_RE.sub(_pyrepr_sub, r.content))
+
 
+async def get_user(user_id: int):
+	"""Fetch a user, serving repeat lookups from the in-process TTL cache."""
+	cached = _USER_CACHE.get(user_id)
+	if cached is not None:
+		return cached
+	user = await _fetch_user(user_id)
+	_USER_CACHE[user_id] = user
+	return user
 
-def create_user(user_payload: dict):
-	r = httpx.post(_url(USERS_BASE, ""), json=user_payload, timeout=10)
+
+@_USER_BREAKER
+@_retry
+async def _fetch_user(user_id: int):
+	r = await _USERS_CLIENT.get(f"/{user_id}")
 	r.raise_for_status()
-	try:
-		return r.json()
-	except Exception:
-		import json
-		text = r.text
-		cleaned = text.replace("None", "null").replace("True", "true").replace("False", "false")
-		return json.loads(cleaned)
+	return _loads_user(r)
+
+
+@_USER_BREAKER
+async def create_user(user_payload):
+	r = await _USERS_CLIENT.post("", **_json_body(user_payload))
+	r.raise_for_status()
+	created = _loads_user(r)
+	# Drop any stale entry for the (possibly reused) id
+	if isinstance(created, dict):
+		_USER_CACHE.pop(created.get("user_id") or created.get("id"), None)
+	return created
 
 
-def delete_user(user_id: int):
+@_USER_BREAKER
+@_retry
+async def delete_user(user_id: int):
 	"""Delete a user in the atomic users microservice."""
-	r = httpx.delete(_url(USERS_BASE, user_id), timeout=10)
+	_USER_CACHE.pop(user_id, None)
+	r = await _USERS_CLIENT.delete(f"/{user_id}")
 	# raise for status to allow caller to catch errors consistently
 	r.raise_for_status()
+	# Evict again: a get_user that raced the DELETE may have re-cached the user
+	_USER_CACHE.pop(user_id, None)
 	if r.status_code == 204 or not r.text:
 		return {"status": "deleted", "id": user_id}
-	return r.json()
\ No newline at end of file
+	return orjson.loads(r.content)
\ No newline at end of file
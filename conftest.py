@@ -0,0 +1,37 @@
+# Root conftest: makes the top-level modules (api_client, main, models)
+# importable under plain `pytest` and provides a mocked upstream.
+import asyncio
+
+import httpx
+import pytest
+from tenacity import wait_none
+
+import api_client
+
+
+class Upstream:
+    """Mock atomic services: records every request and answers via `handler`."""
+
+    def __init__(self):
+        self.requests = []
+        self.handler = lambda request: httpx.Response(404)
+
+    def __call__(self, request):
+        self.requests.append(request)
+        return self.handler(request)
+
+    @property
+    def calls(self):
+        return [f"{r.method} {r.url.path}" for r in self.requests]
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Route api_client through a mock transport with immediate retries."""
+    monkeypatch.setattr(api_client, "RETRY_BACKOFF", wait_none())
+    api_client.reset_state()
+    mock = Upstream()
+    api_client.open_clients(transport=httpx.MockTransport(mock))
+    yield mock
+    asyncio.run(api_client.close_clients())
+    api_client.reset_state()
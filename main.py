@@ -1,5 +1,6 @@
 # main.py
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import Field
 from typing import Optional, Any, Dict
 from models import (
@@ -17,25 +18,109 @@ from models import (
 )
 from api_client import (
     get_addresses,
+    stream_addresses,
     delete_address,
     get_user,
     create_user,
     delete_user,
     create_address_atomic,
     get_address,
+    get_addresses_by_ids,
+    open_clients,
+    close_clients,
+    CircuitBreakerError,
 )
+import asyncio
 import httpx
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
 
-app = FastAPI(title="Composite Microservice")
+app = FastAPI(title="Composite Microservice", default_response_class=ORJSONResponse)
 
 # In-memory mapping to demonstrate logical foreign-key relationships
 # Maps address_id -> user_id
 ADDR_USER_MAP = {}
+# Reverse index of ADDR_USER_MAP: user_id -> {address_id, ...}
+USER_ADDR_MAP: Dict[int, set] = defaultdict(set)
+# Both maps are only mutated from the event loop by the await-free helpers
+# below, so each update is atomic without a lock.
+
+
+def _link_address(addr_id, user_id) -> None:
+    """Record address_id -> user_id in both the forward and reverse maps."""
+    aid, uid = str(addr_id), int(user_id)
+    # Drop any previous owner first so the reverse index never lists it twice
+    _unlink_address(aid)
+    ADDR_USER_MAP[aid] = uid
+    USER_ADDR_MAP[uid].add(aid)
+
+
+def _unlink_address(address_id: str) -> None:
+    """Remove an address from both the forward and reverse maps."""
+    user_id = ADDR_USER_MAP.pop(address_id, None)
+    owned = USER_ADDR_MAP.get(user_id)
+    if owned is not None:
+        owned.discard(address_id)
+        if not owned:
+            del USER_ADDR_MAP[user_id]
+
+
+# Service-wide cap on concurrent upstream fan-out calls (bulkhead); created
+# on startup so it belongs to the running event loop.
+_FANOUT_LIMIT: Optional[asyncio.Semaphore] = None
+
+
+async def _relay(upstream: httpx.Response):
+    """Yield an upstream body, always releasing its pooled connection.
+
+    Starlette skips a response's background task when the client disconnects
+    or the stream fails, so the close must live in the generator itself.
+    """
+    try:
+        async for chunk in upstream.aiter_bytes():
+            yield chunk
+    finally:
+        await upstream.aclose()
+
+
+async def _bounded(coro):
+    async with _FANOUT_LIMIT:
+        return await coro
+
+
+# Query parameters forwarded to the atomic addresses service
+_ADDRESS_PARAMS = ("limit", "offset", "name", "street", "unit", "city", "state", "postal_code", "country")
+
+
+def _address_params(as_geojson: bool = False, **filters) -> Dict[str, Any]:
+    """Build upstream address query params, dropping unset (None) filters."""
+    params = {k: v for k in _ADDRESS_PARAMS if (v := filters.get(k)) is not None}
+    # Convert boolean to string the atomic addresses service expects
+    params["as_geojson"] = "true" if as_geojson else "false"
+    return params
+
+
+@app.on_event("startup")
+async def startup():
+    global _FANOUT_LIMIT
+    # Upstream connection pools and the fan-out cap live for one application lifespan
+    open_clients()
+    _FANOUT_LIMIT = asyncio.Semaphore(32)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Release pooled upstream connections
+    await close_clients()
+
+
+@app.exception_handler(CircuitBreakerError)
+async def circuit_open_handler(request: Request, exc: CircuitBreakerError):
+    # Upstream circuit is open: fail fast instead of waiting on the timeout
+    return ORJSONResponse(status_code=503, content={"detail": str(exc)})
 
 
 @app.get("/addresses", response_model=AddressListResponse)
-def addresses(
+async def addresses(
     limit: int = 10,
     offset: int = 0,
     name: Optional[str] = None,
@@ -48,58 +133,55 @@ def addresses(
     as_geojson: bool = False,
 ):
     """List addresses with query parameters exposed in OpenAPI.
+
+    The upstream body is streamed straight through without being parsed and
+    re-serialized; `response_model` only documents the shape.
     """
-    params = {
-        "limit": limit,
-        "offset": offset,
-        "as_geojson": "true" if as_geojson else "false",
-    }
-    # optional filters
-    if name:
-        params["name"] = name
-    if street:
-        params["street"] = street
-    if unit:
-        params["unit"] = unit
-    if city:
-        params["city"] = city
-    if state:
-        params["state"] = state
-    if postal_code:
-        params["postal_code"] = postal_code
-    if country:
-        params["country"] = country
-
-    return get_addresses(params)
+    params = _address_params(
+        as_geojson,
+        limit=limit,
+        offset=offset,
+        name=name,
+        street=street,
+        unit=unit,
+        city=city,
+        state=state,
+        postal_code=postal_code,
+        country=country,
+    )
+    upstream = await stream_addresses(params)
+    return StreamingResponse(
+        _relay(upstream),
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "application/json"),
+    )
 
 
 @app.post("/addresses/query", response_model=AddressListResponse)
-def addresses_query(query: AddressQuery):
+async def addresses_query(query: AddressQuery):
     """Search addresses with a JSON body. Use this if you prefer JSON filters
     instead of URL query parameters.
     """
-    params = query.model_dump()
-    # Convert boolean to string the atomic addresses service expects
-    if "as_geojson" in params:
-        params["as_geojson"] = "true" if params["as_geojson"] else "false"
-    # Remove None values
-    params = {k: v for k, v in params.items() if v is not None}
+    params = _address_params(**query.model_dump())
     try:
-        return get_addresses(params)
+        # Pass-through: return upstream data as-is rather than re-validating it
+        # against response_model, which is kept for OpenAPI only.
+        return ORJSONResponse(content=await get_addresses(params))
     except httpx.HTTPStatusError as e:
         # Upstream returned non-2xx
         status = e.response.status_code if e.response is not None else 502
         raise HTTPException(status_code=502, detail=f"Upstream addresses service error: {status} - {e}")
+    except CircuitBreakerError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/addresses/{address_id}")
-def delete(address_id: str):
+async def delete(address_id: str):
     # Forward delete to atomic addresses service and remove logical mapping
-    result = delete_address(address_id)
-    if address_id in ADDR_USER_MAP:
-        del ADDR_USER_MAP[address_id]
+    result = await delete_address(address_id)
+    _unlink_address(address_id)
     return result
 
 
@@ -107,31 +189,36 @@ def delete(address_id: str):
 # Delegation for Users (atomic user microservice)
 # -----------------------------
 @app.get("/users/{user_id}", response_model=UserResponse)
-def users_get(user_id: int, request: Request):
+async def users_get(user_id: int, request: Request):
     try:
-        return get_user(user_id)
+        return await get_user(user_id)
     except httpx.HTTPStatusError as e:
         # Map 404 from atomic service to a clear composite 404
         if e.response is not None and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"User {user_id} not found")
         raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+    except CircuitBreakerError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
 @app.post("/users", response_model=UserResponse)
-def users_create(payload: UserCreatePayload):
+async def users_create(payload: UserCreatePayload):
     # Pass-through to atomic users service using typed model so OpenAPI shows examples
-    return create_user(payload.model_dump())
+    return await create_user(payload)
 
 
 # -----------------------------
 # Composite endpoints that combine users + addresses
 # -----------------------------
 @app.post("/addresses", response_model=CompositeAddressResponse)
-def composite_create_address(payload: CompositeAddressCreate):
+async def composite_create_address(payload: CompositeAddressCreate):
     """Composite create: enforce logical FK to users service before delegating.
+
+    The FK check goes through the cached get_user, so repeat creates for the
+    same user skip the users service round trip.
     """
     user_id = payload.user_id
     if not user_id:
@@ -139,21 +226,18 @@ def composite_create_address(payload: CompositeAddressCreate):
 
     # Verify user exists in users atomic microservice
     try:
-        get_user(user_id)
+        await get_user(user_id)
     except httpx.HTTPStatusError as e:
         if e.response is not None and e.response.status_code == 404:
             raise HTTPException(status_code=400, detail=f"User {user_id} does not exist")
         raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+    except CircuitBreakerError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    # Compose address payload for atomic service (remove user_id if atomic doesn't expect it)
-    # Convert to dict and strip user_id for atomic address creation
-    atomic_payload = {
-        k: v for k, v in payload.model_dump().items() if k != "user_id"
-    }
-
-    created = create_address_atomic(atomic_payload)
+    # Strip user_id from the atomic address payload (atomic doesn't expect it)
+    created = await create_address_atomic(payload, exclude={"user_id"})
 
     # Try to extract an id from created response to maintain mapping
     addr_id = None
@@ -161,7 +245,7 @@ def composite_create_address(payload: CompositeAddressCreate):
         addr_id = created.get("id") or created.get("data", {}).get("id")
 
     if addr_id:
-        ADDR_USER_MAP[str(addr_id)] = int(user_id)
+        _link_address(addr_id, user_id)
 
     # Return created resource augmented with logical link to user
     # Normalize created into AddressRead where possible
@@ -169,59 +253,61 @@ def composite_create_address(payload: CompositeAddressCreate):
 
 
 @app.get("/users/{user_id}/addresses", response_model=UserAddressesResponse)
-def get_addresses_for_user(user_id: int):
+async def get_addresses_for_user(user_id: int):
     """Return all addresses associated with a user using the composite mapping.
 
-    This demonstrates logical FK enforcement and uses threads to fetch each
-    address from the atomic address service in parallel.
+    This demonstrates logical FK enforcement. Addresses are fetched in one
+    batch query when the atomic address service supports it, otherwise each
+    one is fetched concurrently.
     """
-    # Find address IDs belonging to user
-    address_ids = [aid for aid, uid in ADDR_USER_MAP.items() if uid == int(user_id)]
+    # Find address IDs belonging to user (user_id is already an int from the route)
+    address_ids = list(USER_ADDR_MAP.get(user_id, ()))
 
     if not address_ids:
-        return {"user_id": user_id, "addresses": []}
-
-    results = []
-    # Fetch addresses concurrently
-    with ThreadPoolExecutor(max_workers=8) as ex:
-        futures = {ex.submit(get_address, aid): aid for aid in address_ids}
-        for fut in as_completed(futures):
-            aid = futures[fut]
-            try:
-                results.append(fut.result())
-            except Exception:
-                # If an address lookup fails, skip it (could happen if atomic resource removed)
-                continue
+        return UserAddressesResponse(user_id=user_id, addresses=[])
+
+    try:
+        batch = await get_addresses_by_ids(address_ids)
+    except CircuitBreakerError:
+        # Addresses service is down: surface it (503) rather than "no addresses"
+        raise
+    except Exception:
+        batch = None
+    if batch is not None:
+        return UserAddressesResponse(user_id=user_id, addresses=batch)
+
+    # Fall back to fetching addresses concurrently
+    fetched = await asyncio.gather(*(_bounded(get_address(aid)) for aid in address_ids), return_exceptions=True)
+    for r in fetched:
+        if isinstance(r, CircuitBreakerError):
+            raise r
+    # If an address lookup fails, skip it (could happen if atomic resource removed)
+    results = [r for r in fetched if not isinstance(r, Exception)]
 
     return UserAddressesResponse(user_id=user_id, addresses=results)
 
 
 @app.get("/users/{user_id}/profile", response_model=UserProfileResponse)
-def user_profile(user_id: int):
+async def user_profile(user_id: int):
     """Composite view that returns user info and their addresses.
 
-    This endpoint fetches the user and addresses in parallel (threads) to
+    This endpoint fetches the user and addresses concurrently to
     demonstrate concurrent delegation.
     """
-    results = {}
-    with ThreadPoolExecutor(max_workers=2) as ex:
-        future_user = ex.submit(get_user, user_id)
-        future_addresses = ex.submit(lambda: get_addresses_for_user(user_id))
-        # wait for both
-        try:
-            results["user"] = future_user.result()
-        except Exception as e:
-            raise HTTPException(status_code=404, detail=f"User lookup failed: {e}")
-        try:
-            results["addresses"] = future_addresses.result().get("addresses", [])
-        except Exception:
-            results["addresses"] = []
+    user, user_addresses = await asyncio.gather(
+        get_user(user_id), get_addresses_for_user(user_id), return_exceptions=True
+    )
+    if isinstance(user, CircuitBreakerError):
+        raise HTTPException(status_code=503, detail=str(user))
+    if isinstance(user, Exception):
+        raise HTTPException(status_code=404, detail=f"User lookup failed: {user}")
+    addresses = [] if isinstance(user_addresses, Exception) else user_addresses.addresses
 
-    return UserProfileResponse(user=results["user"], addresses=results["addresses"])
+    return UserProfileResponse(user=user, addresses=addresses)
 
 
 @app.post("/users_with_address", response_model=UsersWithAddressResponse)
-def create_user_and_address(payload: UsersWithAddressRequest) -> UsersWithAddressResponse:
+async def create_user_and_address(payload: UsersWithAddressRequest) -> UsersWithAddressResponse:
     """Create a user and an address in a single composite operation.
 
     Payload shape:
@@ -236,16 +322,18 @@ def create_user_and_address(payload: UsersWithAddressRequest) -> UsersWithAddres
     - store the logical mapping address_id -> user_id
     - on address creation failure, attempt to rollback (delete) the newly-created user
     """
-    user_payload = payload.user.model_dump()
+    user_payload = payload.user
     address_payload = payload.address.model_dump()
     if not user_payload or not address_payload:
         raise HTTPException(status_code=400, detail="`user` and `address` objects are required")
 
     # 1) Create user
     try:
-        created_user = create_user(user_payload)
+        created_user = await create_user(user_payload)
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=502, detail=f"Upstream user creation failed: {e}")
+    except CircuitBreakerError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -262,17 +350,23 @@ def create_user_and_address(payload: UsersWithAddressRequest) -> UsersWithAddres
     try:
         # Add user_id to address payload for the composite mapping (composite strips before calling atomic)
         address_payload_with_user = {**address_payload, "user_id": user_id}
-        created_address = create_address_atomic(address_payload_with_user)
+        created_address = await create_address_atomic(address_payload_with_user)
     except httpx.HTTPStatusError as e:
         # Address creation failed — attempt to rollback user
         try:
-            delete_user(user_id)
+            await delete_user(user_id)
         except Exception:
             pass
         raise HTTPException(status_code=502, detail=f"Upstream address creation failed: {e}")
+    except CircuitBreakerError as e:
+        try:
+            await delete_user(user_id)
+        except Exception:
+            pass
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         try:
-            delete_user(user_id)
+            await delete_user(user_id)
         except Exception:
             pass
         raise HTTPException(status_code=500, detail=str(e))
@@ -283,6 +377,6 @@ def create_user_and_address(payload: UsersWithAddressRequest) -> UsersWithAddres
         addr_id = created_address.get("id") or created_address.get("data", {}).get("id")
 
     if addr_id:
-        ADDR_USER_MAP[str(addr_id)] = int(user_id)
+        _link_address(addr_id, user_id)
 
     return UsersWithAddressResponse(user=created_user, address=created_address)
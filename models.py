@@ -28,6 +28,11 @@ class UserCreatePayload(BaseModel):
     }
 
 
+# Example payloads reused by the composite models below. Read straight from
+# model_config so no JSON schema has to be generated at import time.
+_USER_CREATE_EXAMPLE = UserCreatePayload.model_config["json_schema_extra"]["examples"][0]
+
+
 class AddressCreatePayload(BaseModel):
     name: str = Field(..., example="Amy Home")
     street: str = Field(..., example="123 Main St")
@@ -54,6 +59,9 @@ class AddressCreatePayload(BaseModel):
     }
 
 
+_ADDRESS_CREATE_EXAMPLE = AddressCreatePayload.model_config["json_schema_extra"]["examples"][0]
+
+
 class UsersWithAddressRequest(BaseModel):
     user: UserCreatePayload
     address: AddressCreatePayload
@@ -62,8 +70,8 @@ class UsersWithAddressRequest(BaseModel):
         "json_schema_extra": {
             "examples": [
                 {
-                    "user": UserCreatePayload.model_json_schema()["examples"][0],
-                    "address": AddressCreatePayload.model_json_schema()["examples"][0]
+                    "user": _USER_CREATE_EXAMPLE,
+                    "address": _ADDRESS_CREATE_EXAMPLE
                 }
             ]
         }
@@ -121,6 +129,9 @@ class UserResponse(BaseModel):
     }
 
 
+_USER_EXAMPLE = UserResponse.model_config["json_schema_extra"]["examples"][0]
+
+
 class AddressRead(BaseModel):
     id: str
     name: Optional[str] = None
@@ -152,6 +163,9 @@ class AddressRead(BaseModel):
     }
 
 
+_ADDRESS_READ_EXAMPLE = AddressRead.model_config["json_schema_extra"]["examples"][0]
+
+
 class AddressListResponse(BaseModel):
     data: List[AddressRead]
     links: List[Dict[str, Any]]
@@ -161,7 +175,7 @@ class AddressListResponse(BaseModel):
         "json_schema_extra": {
             "examples": [
                 {
-                    "data": [AddressRead.model_json_schema()["examples"][0]],
+                    "data": [_ADDRESS_READ_EXAMPLE],
                     "links": [{"rel": "current", "href": "/addresses?limit=10&offset=0"}],
                     "total": 1
                 }
@@ -229,7 +243,7 @@ class CompositeAddressResponse(BaseModel):
         "json_schema_extra": {
             "examples": [
                 {
-                    "address": AddressRead.model_json_schema()["examples"][0],
+                    "address": _ADDRESS_READ_EXAMPLE,
                     "user_id": 1
                 }
             ]
@@ -246,7 +260,7 @@ class UserAddressesResponse(BaseModel):
             "examples": [
                 {
                     "user_id": 1,
-                    "addresses": [AddressRead.model_json_schema()["examples"][0]]
+                    "addresses": [_ADDRESS_READ_EXAMPLE]
                 }
             ]
         }
@@ -261,8 +275,8 @@ class UserProfileResponse(BaseModel):
         "json_schema_extra": {
             "examples": [
                 {
-                    "user": UserResponse.model_json_schema()["examples"][0],
-                    "addresses": [AddressRead.model_json_schema()["examples"][0]]
+                    "user": _USER_EXAMPLE,
+                    "addresses": [_ADDRESS_READ_EXAMPLE]
                 }
             ]
         }
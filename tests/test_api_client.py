@@ -0,0 +1,256 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+
+import api_client
+from api_client import CircuitBreaker, CircuitBreakerError
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", "http://upstream/")
+    response = httpx.Response(status, request=request)
+    return httpx.HTTPStatusError(f"{status}", request=request, response=response)
+
+
+def orjson_body(request: httpx.Request):
+    return orjson.loads(request.content)
+
+
+def _flaky(errors):
+    """Async callable that raises the queued errors in order, then returns "ok"."""
+    calls = []
+
+    async def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    return func, calls
+
+
+def test_breaker_opens_after_fail_max_and_fails_fast():
+    func, calls = _flaky([httpx.ConnectError("down")] * 2)
+    breaker = CircuitBreaker("test", fail_max=2, reset_timeout=60)
+    guarded = breaker(func)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                await guarded()
+        with pytest.raises(CircuitBreakerError):
+            await guarded()
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert breaker.state == "open"
+
+
+def test_breaker_half_open_trial_closes_circuit():
+    func, calls = _flaky([_status_error(503)])
+    breaker = CircuitBreaker("test", fail_max=1, reset_timeout=0)
+    guarded = breaker(func)
+
+    async def run():
+        with pytest.raises(httpx.HTTPStatusError):
+            await guarded()
+        # reset_timeout elapsed: a single trial call goes through and succeeds
+        assert breaker.state == "half_open"
+        assert await guarded() == "ok"
+
+    asyncio.run(run())
+    assert breaker.state == "closed"
+
+
+def test_breaker_ignores_client_errors():
+    func, calls = _flaky([_status_error(404)] * 3)
+    guarded = CircuitBreaker("test", fail_max=2, reset_timeout=60)(func)
+
+    async def run():
+        for _ in range(3):
+            with pytest.raises(httpx.HTTPStatusError):
+                await guarded()
+        assert await guarded() == "ok"
+
+    asyncio.run(run())
+
+
+def test_retries_count_as_one_breaker_failure(upstream):
+    upstream.handler = lambda request: httpx.Response(500)
+    fail_max = api_client._USER_BREAKER.fail_max
+
+    async def run():
+        for _ in range(fail_max):
+            with pytest.raises(httpx.HTTPStatusError):
+                await api_client.get_user(1)
+        with pytest.raises(CircuitBreakerError):
+            await api_client.get_user(1)
+
+    asyncio.run(run())
+    # Every logical call made all 3 attempts; the open circuit made none
+    assert len(upstream.requests) == 3 * fail_max
+
+
+def test_timeouts_are_not_retried(upstream):
+    def hang(request):
+        raise httpx.ReadTimeout("upstream hung", request=request)
+
+    upstream.handler = hang
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(api_client.get_user(1))
+    assert len(upstream.requests) == 1
+
+
+def test_connection_errors_are_retried(upstream):
+    responses = [httpx.ConnectError("reset"), httpx.Response(200, json={"user_id": 1})]
+
+    def flaky(request):
+        result = responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    upstream.handler = flaky
+    assert asyncio.run(api_client.get_user(1)) == {"user_id": 1}
+    assert len(upstream.requests) == 2
+
+
+def _batch(upstream, body, status=200):
+    upstream.handler = lambda request: httpx.Response(status, json=body)
+    return asyncio.run(api_client.get_addresses_by_ids(["a1", "a2"]))
+
+
+def test_batch_lookup_returns_requested_addresses(upstream):
+    records = _batch(upstream, {"data": [{"id": "a2"}, {"id": "a1"}], "links": [], "total": 2})
+    assert sorted(r["id"] for r in records) == ["a1", "a2"]
+    request = upstream.requests[0]
+    assert request.url.path == "/addresses/query"
+    assert orjson_body(request) == {"ids": ["a1", "a2"], "limit": 2}
+
+
+def test_batch_lookup_accepts_bare_list(upstream):
+    assert _batch(upstream, [{"id": "a1"}, {"id": "a2"}]) == [{"id": "a1"}, {"id": "a2"}]
+
+
+def test_batch_lookup_disabled_when_upstream_ignores_ids(upstream):
+    assert _batch(upstream, {"data": [{"id": "OTHER"}, {"id": "a1"}]}) is None
+    # Later calls skip the POST entirely
+    assert asyncio.run(api_client.get_addresses_by_ids(["a1"])) is None
+    assert len(upstream.requests) == 1
+
+
+def test_batch_lookup_missing_id_falls_back_without_disabling(upstream):
+    assert _batch(upstream, {"data": [{"id": "a1"}]}) is None
+    assert _batch(upstream, {"data": [{"id": "a1"}, {"id": "a2"}]}) is not None
+
+
+@pytest.mark.parametrize("status", [400, 404, 405, 422])
+def test_batch_lookup_disabled_on_client_error(upstream, status):
+    assert _batch(upstream, {"detail": "nope"}, status=status) is None
+    assert asyncio.run(api_client.get_addresses_by_ids(["a1"])) is None
+    assert len(upstream.requests) == 1
+
+
+def test_batch_lookup_raises_on_server_error(upstream):
+    with pytest.raises(httpx.HTTPStatusError):
+        _batch(upstream, {"detail": "boom"}, status=500)
+
+
+def _user_body(upstream, body: bytes):
+    upstream.handler = lambda request: httpx.Response(200, content=body)
+    return asyncio.run(api_client.get_user(1))
+
+
+def test_pyrepr_fallback_converts_bare_literals(upstream):
+    body = b'{"user_id": 1, "phone": None, "active": True, "admin": False}'
+    assert _user_body(upstream, body) == {"user_id": 1, "phone": None, "active": True, "admin": False}
+
+
+def test_pyrepr_fallback_keeps_string_values(upstream):
+    body = b'{"first_name": "True", "last_name": "None", "note": "Noneed", "phone": None}'
+    assert _user_body(upstream, body) == {
+        "first_name": "True",
+        "last_name": "None",
+        "note": "Noneed",
+        "phone": None,
+    }
+
+
+def test_pyrepr_fallback_handles_escaped_quotes(upstream):
+    body = rb'{"bio": "says \"True\" \\", "phone": None}'
+    assert _user_body(upstream, body) == {"bio": 'says "True" \\', "phone": None}
+
+
+def test_pyrepr_fallback_can_be_disabled(upstream, monkeypatch):
+    monkeypatch.setattr(api_client, "USERS_PYREPR_FALLBACK", False)
+    with pytest.raises(orjson.JSONDecodeError):
+        _user_body(upstream, b'{"phone": None}')
+
+
+USER = {"user_id": 1, "first_name": "Amy", "last_name": "Adams", "email": "amy@example.com"}
+
+
+def _users_service(upstream):
+    def handler(request):
+        if request.method == "GET":
+            return httpx.Response(200, json=USER)
+        if request.method == "POST":
+            return httpx.Response(201, json=USER)
+        return httpx.Response(204)
+
+    upstream.handler = handler
+
+
+def test_get_user_serves_repeat_lookups_from_cache(upstream):
+    _users_service(upstream)
+
+    async def run():
+        assert await api_client.get_user(1) == USER
+        assert await api_client.get_user(1) == USER
+
+    asyncio.run(run())
+    assert upstream.calls == ["GET /api/v1/users/1"]
+
+
+@pytest.mark.parametrize("mutate", ["delete", "create"])
+def test_user_writes_evict_cache(upstream, mutate):
+    _users_service(upstream)
+
+    async def run():
+        await api_client.get_user(1)
+        if mutate == "delete":
+            await api_client.delete_user(1)
+        else:
+            await api_client.create_user({"first_name": "Amy"})
+        await api_client.get_user(1)
+
+    asyncio.run(run())
+    assert [c for c in upstream.calls if c.startswith("GET")] == ["GET /api/v1/users/1"] * 2
+
+
+def test_delete_user_evicts_user_recached_during_delete(upstream):
+    async def run():
+        release = asyncio.Event()
+
+        async def slow_delete(request):
+            await release.wait()
+            return httpx.Response(204)
+
+        def handler(request):
+            if request.method == "DELETE":
+                return slow_delete(request)
+            return httpx.Response(200, json=USER)
+
+        upstream.handler = handler
+        deleting = asyncio.create_task(api_client.delete_user(1))
+        await asyncio.sleep(0)
+        # A concurrent lookup re-caches the user while the DELETE is in flight
+        await api_client.get_user(1)
+        release.set()
+        await deleting
+        await api_client.get_user(1)
+
+    asyncio.run(run())
+    assert upstream.calls.count("GET /api/v1/users/1") == 2
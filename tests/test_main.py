@@ -0,0 +1,84 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import api_client
+import main
+
+
+@pytest.fixture
+def client(upstream, monkeypatch):
+    # Make the app's startup hook open clients on the mocked upstream
+    transport = httpx.MockTransport(upstream)
+    monkeypatch.setattr(main, "open_clients", lambda: api_client.open_clients(transport=transport))
+    with TestClient(main.app) as c:
+        yield c
+    main.ADDR_USER_MAP.clear()
+    main.USER_ADDR_MAP.clear()
+
+
+def test_user_addresses_report_open_circuit_as_503(client, upstream):
+    main._link_address("a1", 1)
+    main._link_address("a2", 1)
+    upstream.handler = lambda request: httpx.Response(503)
+    # Trip the addresses breaker, then the composite must not claim "no addresses"
+    for _ in range(api_client._ADDR_BREAKER.fail_max):
+        client.get("/users/1/addresses")
+    upstream.requests.clear()
+
+    r = client.get("/users/1/addresses")
+    assert r.status_code == 503
+    assert upstream.requests == []
+
+
+def test_address_list_relay_closes_upstream_stream(client, upstream):
+    closed = []
+
+    class Body(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield b'{"data": [], "links": [], '
+            yield b'"total": 0}'
+
+        async def aclose(self):
+            closed.append(True)
+
+    upstream.handler = lambda request: httpx.Response(
+        200, headers={"content-type": "application/json"}, stream=Body()
+    )
+    r = client.get("/addresses")
+    assert r.json() == {"data": [], "links": [], "total": 0}
+    assert closed == [True]
+
+
+def test_address_relay_closes_upstream_when_client_stops_reading():
+    closed = []
+
+    class Body(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            for _ in range(3):
+                yield b"chunk"
+
+        async def aclose(self):
+            closed.append(True)
+
+    async def run():
+        relay = main._relay(httpx.Response(200, stream=Body()))
+        assert await relay.__anext__() == b"chunk"
+        # What Starlette does when the client disconnects mid-stream
+        await relay.aclose()
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_relinking_an_address_moves_it_between_users():
+    main._link_address("a1", 1)
+    main._link_address("a1", 2)
+    try:
+        assert main.ADDR_USER_MAP == {"a1": 2}
+        assert dict(main.USER_ADDR_MAP) == {2: {"a1"}}
+    finally:
+        main.ADDR_USER_MAP.clear()
+        main.USER_ADDR_MAP.clear()